@@ -0,0 +1,47 @@
+import json
+import logging
+
+from time import perf_counter
+
+from gcd.monitor import ContextFilter, DictFormatter, JsonFormatter
+
+
+class LegacyJsonFormatter(logging.Formatter):  # As it was, for comparison.
+    attrs = "name", "levelname", "created", "context"
+
+    def format(self, record):
+        log = {a: getattr(record, a) for a in self.attrs if hasattr(record, a)}
+        if isinstance(record.msg, dict):
+            log.update(record.msg)
+        else:
+            log["message"] = record.getMessage()
+        return (lambda log: json.dumps(log))(log)
+
+
+def bench_format(number=100000):
+    context = ContextFilter(host=True, service="bench", version="1.2.3")
+    records = []
+    for i in range(number):
+        record = logging.makeLogRecord(
+            {"name": "bench", "levelname": "INFO", "msg": {"i": i, "x": "x" * 20}}
+        )
+        context.filter(record)
+        records.append(record)
+    formatters = [("legacy json", LegacyJsonFormatter()), ("dict", DictFormatter())]
+    for backend in "json", "orjson", "ujson":
+        for as_bytes in False, True:
+            try:
+                formatter = JsonFormatter(backend=backend, as_bytes=as_bytes)
+            except ImportError:
+                continue
+            formatters.append(("%s%s" % (backend, " bytes" * as_bytes), formatter))
+    for name, formatter in formatters:
+        t0 = perf_counter()
+        for record in records:
+            formatter.format(record)
+        secs = perf_counter() - t0
+        print("%-16s %12.0f records/s" % (name, number / secs))
+
+
+if __name__ == "__main__":
+    bench_format()
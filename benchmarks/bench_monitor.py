@@ -0,0 +1,139 @@
+import timeit
+import tracemalloc
+import threading
+
+from time import perf_counter
+from contextlib import contextmanager
+
+from gcd.monitor import Statistics, Monitor, ShardedMonitor, Span
+
+
+def bench(name, fun, number):
+    secs = min(timeit.repeat(fun, number=number, repeat=3)) / number
+    print("%-48s %12.3f us" % (name, secs * 1e6))
+
+
+def bench_add_many(size=10000):
+    import numpy as np
+
+    xs = np.random.random(size)
+    ts = 1e9 + np.arange(size) / 1000
+    for memory in 1, 0.9:
+        for full in False, True:
+
+            def scalar():
+                stats = Statistics(memory, full)
+                for x, t in zip(xs.tolist(), ts.tolist()):
+                    stats.add(x, 1, t)
+
+            def vectorized():
+                Statistics(memory, full).add_many(xs, times=ts)
+
+            config = "memory=%s full=%s, %s samples" % (memory, full, size)
+            bench("add loop, " + config, scalar, 10)
+            bench("add_many, " + config, vectorized, 10)
+
+
+class LockedMonitor(Monitor):
+    lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+
+def bench_contention(threads=8, updates=100000):
+    def work(monitor):
+        locked = getattr(monitor, "locked", None)
+        for i in range(updates):
+            if locked:
+                with locked():
+                    monitor["count",] += 1
+                    monitor.stats("x", full=True).add(i)
+            else:
+                monitor["count",] += 1
+                monitor.stats("x", full=True).add(i)
+
+    for monitor in Monitor(), LockedMonitor(), ShardedMonitor():
+        workers = [
+            threading.Thread(target=work, args=(monitor,)) for _ in range(threads)
+        ]
+        t0 = perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        secs = perf_counter() - t0
+        info = monitor.info()
+        print(
+            "%-16s %8.3f s, count %s/%s, stats n %.0f"
+            % (
+                type(monitor).__name__,
+                secs,
+                info["count"],
+                threads * updates,
+                info["x"]["n"],
+            )
+        )
+
+
+def bench_cardinality(keys=100000):
+    def stats_monitor():
+        monitor = Monitor()
+        for i in range(keys):
+            monitor.stats("latency", i % 100, i, memory=0.9, full=True).add(i)
+        return monitor
+
+    def family_monitor():
+        monitor = Monitor()
+        family = monitor.family("latency", memory=0.9, full=True)
+        for i in range(keys):
+            family.add((i % 100, i), i)
+        return monitor
+
+    for build in stats_monitor, family_monitor:
+        tracemalloc.start()
+        monitor = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        t0 = perf_counter()
+        monitor.info()
+        secs = perf_counter() - t0
+        print(
+            "%-16s %8.1f MB, info %.3f s, %s keys"
+            % (build.__name__, size / 2 ** 20, secs, keys)
+        )
+
+
+def bench_span(number=100000):
+    def nop():
+        pass
+
+    monitor = Monitor()
+    span, sampled = monitor.span("span"), monitor.span("sampled", sample=100)
+    timed, untimed = span(nop), sampled(nop)
+
+    def nested():
+        with span:
+            with monitor.span("child"):
+                pass
+
+    base = min(timeit.repeat(nop, number=number, repeat=3)) / number
+    for name, fun in [
+        ("decorator", timed),
+        ("decorator, sample=100", untimed),
+        ("context manager, 2 nested", nested),
+    ]:
+        bench("span " + name, fun, number)
+    Span.enabled = False
+    bench("span disabled", timed, number)
+    Span.enabled = True
+    print("%-48s %12.3f us" % ("plain call", base * 1e6))
+
+
+if __name__ == "__main__":
+    bench_add_many()
+    bench_contention()
+    bench_cardinality()
+    bench_span()
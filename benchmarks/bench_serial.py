@@ -0,0 +1,56 @@
+import pickle
+import timeit
+
+from gcd.work import Pickle, Marshal, MsgPack, Struct
+
+
+event = dict(
+    id=123456789,
+    campaign="campaign-42",
+    endpoint="/bid",
+    created=1593000000.123,
+    price=0.42,
+    tags=["a", "b", "c"],
+    geo=dict(country="AR", region="C"),
+)
+record = dict(id=123456789, created=1593000000.123, price=0.42)
+blob = dict(id=1, data=bytearray(1024 ** 2))
+
+
+class DefaultPickle:
+    dumps = staticmethod(pickle.dumps)
+    loads = staticmethod(pickle.loads)
+
+
+def serializers():
+    yield "default pickle", DefaultPickle()
+    yield "pickle 5", Pickle()
+    yield "marshal", Marshal()
+    try:
+        yield "msgpack", MsgPack()
+    except ImportError:
+        pass
+
+
+def bench(name, payload_name, serializer, payload, number):
+    def roundtrip():
+        serializer.loads(serializer.dumps(payload))
+
+    secs = min(timeit.repeat(roundtrip, number=number, repeat=3)) / number
+    print("%-10s %-16s %10.2f us/roundtrip" % (payload_name, name, secs * 1e6))
+
+
+def main():
+    for payload_name, payload, number in (
+        ("event", event, 20000),
+        ("record", record, 20000),
+        ("blob", blob, 200),
+    ):
+        for name, serializer in serializers():
+            bench(name, payload_name, serializer, payload, number)
+    struct = Struct("qdd", ("id", "created", "price"))
+    bench("struct", "record", struct, record, 20000)
+
+
+if __name__ == "__main__":
+    main()
@@ -83,13 +83,20 @@ class Timer:
             now = time.time()
             last_time = (int(now / period) * period) if align else now
             self._next_time = last_time + period
+        self.skipped = 0  # Ticks coalesced by the last is_time.
+
+    @property
+    def next_time(self):
+        return self._next_time
 
     @property
     def is_time(self):
         now = time.time()
         if now >= self._next_time:
+            self.skipped = -1
             while now >= self._next_time:
                 self._next_time += self.period
+                self.skipped += 1
             return True
         else:
             return False
@@ -76,6 +76,18 @@ def cat(path):
         return file.read().strip("\n")
 
 
+def uss(pid="self"):  # Unique set size in bytes, Linux only.
+    path = "/proc/%s/smaps_rollup" % pid
+    if not os.path.exists(path):  # Before Linux 4.14.
+        path = "/proc/%s/smaps" % pid
+    size = 0
+    with open(path) as file:
+        for line in file:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                size += int(line.split()[1])
+    return size * 1024
+
+
 @contextmanager
 def flock(file_or_path, mode="a", shared=False):
     with as_file(file_or_path, mode) as file:
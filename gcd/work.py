@@ -1,11 +1,23 @@
+import os
+import gc
+import mmap
+import struct
+import pickle
+import marshal
 import logging
 import multiprocessing as mp
 import threading as mt
 
-from queue import Empty, Queue
+from time import monotonic, perf_counter, time
+from queue import Empty, Full, Queue
+from heapq import heappush, heappop
+from itertools import count
+from functools import partial
+from collections import deque
 
-from gcd.etc import new
+from gcd.etc import new, chunks, MB
 from gcd.chronos import as_timer
+from gcd.nix import uss
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +43,10 @@ class Process(mp.Process):
         super().start()
         return self
 
+    @property
+    def uss(self):
+        return uss(self.pid)
+
     @staticmethod  # Must be pickleable.
     def _wrapper(init, target, *args, **kwargs):
         if init:
@@ -66,9 +82,22 @@ class Task(Worker):
     class Stop:
         pass
 
-    def __init__(self, period_or_timer, callback, *args, new_process=False, **kwargs):
+    monitor_memory = 0.5, 60  # Halve the weight of the samples every minute.
+
+    def __init__(
+        self,
+        period_or_timer,
+        callback,
+        *args,
+        new_process=False,
+        monitor=None,
+        monitor_key=None,
+        **kwargs
+    ):
         timer = as_timer(period_or_timer)
         self.__stop = False
+        self._monitor = monitor
+        self._monitor_key = monitor_key or type(self).__name__.lower()
         super().__init__(
             self._run, timer, callback, args, kwargs, new_process=new_process
         )
@@ -78,14 +107,40 @@ class Task(Worker):
         return self
 
     def _run(self, timer, callback, args, kwargs):
+        monitor = self._monitor
         while True:
             try:
+                due = timer.next_time
                 timer.wait()
+                if monitor is not None:
+                    self._stats("lateness").add(time() - due)
                 if self.__stop or callback(*args, **kwargs) is Task.Stop:
                     logger.info("Task cleanly stopped")
                     return
-            except Exception:
+            except Exception as error:
                 logger.exception("Error executing task")
+                if monitor is not None:
+                    monitor[self._monitor_key, "errors", type(error).__name__] += 1
+
+    def _stats(self, name):
+        return self._monitor.stats(
+            self._monitor_key, name, memory=self.monitor_memory, full=True
+        )
+
+    def _timeit(self, name):
+        return self._monitor.timeit(self._monitor_key, name, memory=self.monitor_memory)
+
+    def _put(self, obj, *args, **kwargs):
+        if self._monitor is not None:
+            obj = time(), obj  # Keep track of the time spent in the queue.
+        self._queue.put(obj, *args, **kwargs)
+
+    def _unwrap(self, objs):
+        wait = self._stats("wait")
+        now = time()
+        for t, obj in objs:
+            wait.add(now - t)
+            yield obj
 
 
 class Batcher(Task):
@@ -97,9 +152,12 @@ class Batcher(Task):
         period=None,
         queue=None,
         new_process=False,
+        serializer=None,
+        monitor=None,
+        monitor_key=None,
         **kwargs
     ):
-        self._queue = queue or new_queue(hwm, new_process)
+        self._queue = _task_queue(queue, hwm, new_process, serializer, monitor)
         super().__init__(
             period or default_period,
             self._callback,
@@ -107,19 +165,33 @@ class Batcher(Task):
             args,
             kwargs,
             new_process=new_process,
+            monitor=monitor,
+            monitor_key=monitor_key,
         )
 
     def put(self, obj, *args, **kwargs):
-        self._queue.put(obj, *args, **kwargs)
+        self._put(obj, *args, **kwargs)
 
     def join(self):
-        self._queue.put(Task.Stop)
+        self._put(Task.Stop)
         super().join()
 
     def _callback(self, handle_batch, args, kwargs):
-        batch = list(dequeue(self._queue, 1))
+        if self._monitor is None:
+            batch = list(dequeue(self._queue, 1))
+        else:
+            self._stats("queue").add(self._queue.qsize())
+            batch = list(self._unwrap(dequeue(self._queue, 1)))
         stop = batch[-1] is Task.Stop
-        handle_batch(batch[:-1] if stop else batch, *args, **kwargs)
+        if stop:
+            batch.pop()
+            self.stop()  # Stop on the next tick even if handle_batch fails.
+        if self._monitor is None:
+            handle_batch(batch, *args, **kwargs)
+        else:
+            self._stats("batch").add(len(batch))
+            with self._timeit("handle"):
+                handle_batch(batch, *args, **kwargs)
         if stop:
             return Task.Stop
 
@@ -133,53 +205,897 @@ class Streamer(Task):
         period=None,
         queue=None,
         new_process=False,
+        serializer=None,
+        monitor=None,
+        monitor_key=None,
         **kwargs
     ):
-        self._queue = queue or new_queue(hwm, new_process)
+        self._queue = _task_queue(queue, hwm, new_process, serializer, monitor)
         super().__init__(
             period or default_period,
             self._callback,
             load_batch,
-            self._queue.maxsize,
+            getattr(self._queue, "hwm", None) or self._queue.maxsize,
             period,
             args,
             kwargs,
             new_process=new_process,
+            monitor=monitor,
+            monitor_key=monitor_key,
         )
 
     def get(self, *args, **kwargs):
-        return self._queue.get(*args, **kwargs)
+        obj = self._queue.get(*args, **kwargs)
+        if self._monitor is not None:
+            (obj,) = self._unwrap((obj,))
+        return obj
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        obj = self._queue.get()
+        obj = self.get()
         if obj is Task.Stop:
             raise StopIteration
         return obj
 
     def _callback(self, load_batch, hwm, period, args, kwargs):
+        if self._monitor is None:
+            return self._load(load_batch, hwm, period, args, kwargs)
+        self._stats("queue").add(self._queue.qsize())
+        with self._timeit("load"):
+            count = self._load(load_batch, hwm, period, args, kwargs)
+        if count is Task.Stop:
+            return Task.Stop
+        self._stats("batch").add(count)
+
+    def _load(self, load_batch, hwm, period, args, kwargs):
+        count = 0
         for obj in load_batch(hwm, period, *args, **kwargs):
-            self._queue.put(obj)
+            self._put(obj)
             if obj is Task.Stop:
                 return Task.Stop
+            count += 1
+        return count
+
+
+class Supervisor(Task):
+    def __init__(
+        self,
+        target,
+        *args,
+        queue=None,
+        min_workers=1,
+        max_workers=None,
+        backlog=None,
+        idle=3,
+        max_backoff=60,
+        period=None,
+        new_process=True,
+        monitor=None,
+        monitor_key=None,
+        **kwargs
+    ):
+        self._target, self._args, self._kwargs = target, args, kwargs
+        self._queue = queue
+        self.min_workers = min_workers
+        self.max_workers = max_workers or min_workers
+        self.backlog = backlog or default_hwm / 10  # Queued objects per worker.
+        self.idle = idle  # Empty queue ticks before retiring a worker.
+        self.max_backoff = max_backoff
+        self._new_process = new_process
+        self._workers = []
+        self._size = min_workers
+        self._crashes = self._failures = self._idle_ticks = 0
+        self._last_crash = self._respawn_at = 0
+        super().__init__(
+            period or default_period,
+            self._supervise,
+            monitor=monitor,
+            monitor_key=monitor_key,
+        )
+
+    def start(self):
+        for _ in range(self._size):
+            self._workers.append(self._spawn())
+        return super().start()
+
+    def join(self):
+        self.stop()
+        super().join()
+        if self._queue is not None:
+            for _ in self._workers:
+                self._queue.put(Task.Stop)
+        for worker in self._workers:
+            worker.join()
+
+    def info(self):
+        return dict(workers=len(self._workers), size=self._size, crashes=self._crashes)
+
+    def _supervise(self):
+        now = time()
+        workers = []
+        for worker in self._workers:
+            if worker.is_alive():
+                workers.append(worker)
+            elif getattr(worker, "exitcode", 0):  # Crashed, respawn with backoff.
+                self._crashes += 1
+                self._failures += 1  # Consecutive crashes, to compute backoff.
+                self._last_crash = now
+                backoff = min(self.max_backoff, 2 ** (self._failures - 1))
+                self._respawn_at = now + backoff
+                logger.error("Worker crashed with %s", worker.exitcode)
+                if self._monitor is not None:
+                    self._monitor[self._monitor_key, "crashes"] += 1
+            else:  # Cleanly stopped (retired).
+                self._size = max(self._size - 1, self.min_workers)
+        self._workers = workers
+        if self._failures and now - self._last_crash > self.max_backoff:
+            self._failures = 0
+        if self._queue is not None:
+            self._scale(len(workers))
+        if now >= self._respawn_at:
+            while len(self._workers) < self._size:
+                self._workers.append(self._spawn())
+        if self._monitor is not None:
+            self._stats("workers").add(len(self._workers))
+
+    def _scale(self, n):
+        backlog = self._queue.qsize()
+        if backlog > self.backlog * max(n, 1) and self._size < self.max_workers:
+            self._size += 1
+            self._idle_ticks = 0
+        elif backlog == 0 and self._size > self.min_workers:
+            self._idle_ticks += 1
+            if self._idle_ticks >= self.idle:
+                self._queue.put(Task.Stop)  # Some worker will take it and quit.
+                self._idle_ticks = 0
+        else:
+            self._idle_ticks = 0
+
+    def _spawn(self):
+        if self._new_process:
+            worker = Process(self._target, *self._args, **self._kwargs)
+        else:
+            worker = Thread(self._run_thread, *self._args, **self._kwargs)
+        return worker.start()
+
+    def _run_thread(self, *args, **kwargs):
+        try:
+            self._target(*args, **kwargs)
+        except Exception:
+            logger.exception("Error executing worker")
+            mt.current_thread().exitcode = 1  # Mimic a crashed Process.
+
+
+class Job:
+
+    _local = mt.local()
+
+    @staticmethod
+    def active():
+        return getattr(Job._local, "active", None)
+
+    def __init__(
+        self, callback, args, kwargs, due, period, priority, deadline, coalesce, name
+    ):
+        self.callback, self.args, self.kwargs = callback, args, kwargs
+        self.due = due
+        self.period = period
+        self.priority = priority
+        self.deadline = deadline
+        self.coalesce = coalesce
+        self.name = name or getattr(callback, "__name__", "job")
+        self.skipped = 0  # Ticks coalesced into the current run.
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        return self
+
+
+# Runs periodic and one-off jobs on a few worker threads. Due jobs are
+# dealt round robin to per worker queues, ordered by priority, and idle
+# workers steal from the others, so a slow job only delays its own worker.
+# Jobs that can't start within their deadline are skipped as overdue.
+class Scheduler:
+    def __init__(self, workers=2, monitor=None, monitor_key="scheduler"):
+        self._cond = mt.Condition()
+        self._timers = []  # Heap of (due, seq, job).
+        self._ready = [[] for _ in range(workers)]  # Heaps of (-priority, ...).
+        self._locks = [mt.Lock() for _ in range(workers)]
+        self._seq = count()
+        self._stop = False
+        self._monitor = monitor
+        self._monitor_key = monitor_key
+
+    def every(
+        self,
+        period_or_timer,
+        callback,
+        *args,
+        priority=0,
+        deadline=None,
+        coalesce=True,
+        name=None,
+        **kwargs
+    ):
+        timer = as_timer(period_or_timer)
+        job = Job(
+            callback,
+            args,
+            kwargs,
+            timer.next_time,
+            timer.period,
+            priority,
+            deadline,
+            coalesce,
+            name,
+        )
+        return self._schedule(job)
+
+    def after(
+        self, delay, callback, *args, priority=0, deadline=None, name=None, **kwargs
+    ):
+        job = Job(
+            callback, args, kwargs, time() + delay, None, priority, deadline, 0, name
+        )
+        return self._schedule(job)
+
+    def start(self):
+        self._threads = [Thread(self._work, i).start() for i in range(len(self._ready))]
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        return self
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _schedule(self, job):
+        with self._cond:
+            heappush(self._timers, (job.due, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def _work(self, index):
+        while True:
+            job = self._next(index)
+            if job is None:
+                return
+            self._run(job)
+
+    def _next(self, index):
+        while True:
+            self._release()
+            job = self._pop(index)
+            for other in range(1, len(self._ready)):
+                if job is not None:
+                    break
+                job = self._pop((index + other) % len(self._ready))  # Steal.
+            if job is not None:
+                return job
+            with self._cond:
+                if self._stop:
+                    return None
+                if not any(self._ready):
+                    timers = self._timers
+                    self._cond.wait(timers[0][0] - time() if timers else None)
+
+    def _release(self):
+        with self._cond:
+            now, timers = time(), self._timers
+            released = False
+            while timers and timers[0][0] <= now:
+                due, seq, job = heappop(timers)
+                if job.cancelled:
+                    continue
+                home = seq % len(self._ready)
+                with self._locks[home]:
+                    heappush(self._ready[home], (-job.priority, due, seq, job))
+                released = True
+            if released:
+                self._cond.notify_all()
+
+    def _pop(self, index):
+        with self._locks[index]:
+            if self._ready[index]:
+                return heappop(self._ready[index])[-1]
+
+    def _run(self, job):
+        monitor, key = self._monitor, self._monitor_key
+        late = time() - job.due
+        job.skipped = int(late // job.period) if job.period and job.coalesce else 0
+        if monitor is not None:
+            monitor.stats(key, job.name, "lateness", full=True).add(late)
+            if job.skipped:
+                monitor[key, job.name, "skipped"] += job.skipped
+        stop = False
+        if job.deadline is not None and late > job.deadline:
+            logger.warning("Skipping overdue job %s (%.3fs late)", job.name, late)
+            if monitor is not None:
+                monitor[key, job.name, "overdue"] += 1
+        else:
+            Job._local.active = job
+            t0 = perf_counter()
+            try:
+                stop = job.callback(*job.args, **job.kwargs) is Task.Stop
+            except Exception as error:
+                logger.exception("Error executing job %s", job.name)
+                if monitor is not None:
+                    monitor[key, job.name, "errors", type(error).__name__] += 1
+            finally:
+                Job._local.active = None
+                if monitor is not None:
+                    duration = perf_counter() - t0
+                    monitor.stats(key, job.name, "duration", full=True).add(duration)
+        if job.period and not stop and not job.cancelled:
+            job.due += (job.skipped + 1) * job.period
+            self._schedule(job)
+
+
+class Pipeline:
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def __or__(self, stage):
+        return Pipeline(*self.stages, stage)
+
+    def start(self):
+        stages = self.stages
+        if not isinstance(stages[0], Source):
+            raise ValueError("The first stage must be a Source")
+        if any(isinstance(s, Source) for s in stages[1:]):
+            raise ValueError("Only the first stage can be a Source")
+        if any(isinstance(s, Sink) for s in stages[:-1]):
+            raise ValueError("Only the last stage can be a Sink")
+        queue = None
+        for stage, next_stage in zip(stages, stages[1:] + (None,)):
+            if next_stage is None:
+                shared = stage.new_process
+                hwm = stage.hwm
+            else:
+                shared = stage.new_process or next_stage.new_process
+                hwm = next_stage.hwm
+            out_queue = None if isinstance(stage, Sink) else new_queue(hwm, shared)
+            stage.start(queue, out_queue)
+            queue = out_queue
+        self._queue = queue
+        return self
+
+    def stop(self):
+        self.stages[0].stop()
+        return self
+
+    def join(self):
+        for stage in self.stages:
+            stage.join()
+
+    def __iter__(self):
+        return iter(self._queue.get, Task.Stop)
+
+    def info(self):
+        return [stage.info() for stage in self.stages]
+
+
+# Subclasses implement _run(index), the loop of each worker.
+class Stage:
+    def __init__(self, workers=1, new_process=False, hwm=None):
+        self.workers = workers
+        self.new_process = new_process
+        self.hwm = hwm
+        self._in_queue = self._out_queue = self._t0 = None
+        self._counts = mp.RawArray("q", 2 * workers)  # Per worker in/out.
+
+    def __or__(self, stage):
+        return Pipeline(self, stage)
+
+    def start(self, in_queue, out_queue):
+        self._in_queue, self._out_queue = in_queue, out_queue
+        self._t0 = time()
+        self._workers = [
+            Worker(self._run, i, new_process=self.new_process).start()
+            for i in range(self.workers)
+        ]
+        self._closer = Thread(self._close).start()
+        return self
+
+    def join(self):
+        self._closer.join()
+
+    def info(self):
+        counts = self._counts
+        in_count, out_count = sum(counts[::2]), sum(counts[1::2])
+        elapsed = time() - self._t0 if self._t0 else 0
+        info = dict(
+            stage=type(self).__name__,
+            workers=self.workers,
+            input=in_count,
+            output=out_count,
+            rate=(in_count or out_count) / elapsed if elapsed else 0,
+        )
+        if self._in_queue is not None:
+            info["queue"] = self._in_queue.qsize()
+        return info
+
+    def _close(self):
+        for worker in self._workers:
+            worker.join()
+        if self._out_queue is not None:
+            self._out_queue.put(Task.Stop)
+
+
+# Subclasses implement _handle(obj, put), called for each input object.
+class Transform(Stage):
+    def _run(self, index):
+        counts = self._counts
+
+        def put(obj):
+            counts[2 * index + 1] += 1
+            self._out_queue.put(obj)
+
+        while True:
+            obj = self._in_queue.get()
+            if obj is Task.Stop:
+                self._in_queue.put(Task.Stop)  # Let sibling workers stop too.
+                return
+            counts[2 * index] += 1
+            try:
+                self._handle(obj, put)
+            except Exception:
+                logger.exception("Error handling object in %s", type(self).__name__)
+
+
+class Source(Stage):
+    def __init__(self, iterable, new_process=False, hwm=None):
+        super().__init__(1, new_process, hwm)
+        self._iterable = iterable
+        self._stop = mp.Event()
+
+    def stop(self):
+        self._stop.set()
+        return self
+
+    def _run(self, index):
+        counts = self._counts
+        try:
+            for obj in self._iterable:
+                if self._stop.is_set():
+                    break
+                counts[1] += 1
+                self._out_queue.put(obj)
+        except Exception:
+            logger.exception("Error reading Source")
+
+
+class Map(Transform):
+    def __init__(self, fun, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fun = fun
+
+    def _handle(self, obj, put):
+        put(self._fun(obj))
+
+
+class Filter(Transform):
+    def __init__(self, pred, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pred = pred
+
+    def _handle(self, obj, put):
+        if self._pred(obj):
+            put(obj)
+
+
+class Sink(Transform):
+    def __init__(self, handle, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sink = handle
+
+    def _handle(self, obj, put):
+        self._sink(obj)
+
+
+class Batch(Stage):
+    def __init__(self, size, period=None, new_process=False, hwm=None):
+        super().__init__(1, new_process, hwm)
+        self.size = size
+        self.period = period or default_period
+
+    def _run(self, index):
+        counts = self._counts
+        while True:
+            batch = dequeue(self._in_queue, self.size, self.size, self.period)
+            stop = batch and batch[-1] is Task.Stop
+            if stop:
+                batch.pop()
+            if batch:
+                counts[0] += len(batch)
+                counts[1] += 1
+                self._out_queue.put(batch)
+            if stop:
+                return
+
+
+# Unbounded FIFO queue that keeps up to hwm objects in memory and spills the
+# rest to append-only segment files, replayed in order as the consumer catches
+# up. Closing it spills the memory too and records the read position, so a
+# queue reopened on the same path resumes where it stopped. Spilled objects
+# are flushed to the OS on every put, so they survive a process crash (but not
+# an OS crash, there is no fsync); after a crash the objects in memory are lost
+# and the segment being read is replayed from its start.
+class SpillQueue(Queue):
+    _header = struct.Struct("<I")
+
+    def __init__(self, path, hwm=None, segment_size=64 * MB):
+        self.path = path
+        self.hwm = hwm or default_hwm
+        self.segment_size = segment_size
+        super().__init__()
+
+    def close(self):
+        with self.mutex:
+            if self._reader:
+                self._head = self._segs[0], self._offset
+                self._reader.close()
+                self._reader = None
+            if self._mem:
+                seq = self._segs[0] - 1 if self._segs else 0
+                with open(self._seg_path(seq), "wb") as file:
+                    for obj in self._mem:
+                        self._append(file, obj)
+                self._segs.appendleft(seq)
+                self._disk_count += len(self._mem)
+                self._mem.clear()
+            self._seal()
+            if self._head:
+                with open(os.path.join(self.path, "head"), "w") as file:
+                    file.write("%s %s" % self._head)
+
+    def _init(self, maxsize):
+        self._mem = deque()
+        self._segs = deque()
+        self._disk_count = 0
+        self._writer = self._reader = self._head = None
+        self._offset = 0
+        os.makedirs(self.path, exist_ok=True)
+        head_path = os.path.join(self.path, "head")
+        if os.path.exists(head_path):
+            with open(head_path) as file:
+                self._head = tuple(map(int, file.read().split()))
+            os.remove(head_path)
+        names = (n for n in os.listdir(self.path) if n.endswith(".seg"))
+        for seq in sorted(int(n[:-4]) for n in names):
+            offset = self._head[1] if self._head and self._head[0] == seq else 0
+            count = self._scan(self._seg_path(seq), offset)
+            if count:
+                self._segs.append(seq)
+                self._disk_count += count
+            else:
+                os.remove(self._seg_path(seq))
+
+    def _qsize(self):
+        return len(self._mem) + self._disk_count
+
+    def _put(self, obj):
+        if not self._disk_count and len(self._mem) < self.hwm:
+            self._mem.append(obj)
+            return
+        if self._writer is None or self._writer.tell() >= self.segment_size:
+            self._seal()
+            seq = self._segs[-1] + 1 if self._segs else 0
+            self._writer = open(self._seg_path(seq), "ab")
+            self._segs.append(seq)
+        self._append(self._writer, obj)
+        self._writer.flush()
+        self._disk_count += 1
+
+    def _get(self):
+        if not self._mem:
+            # Replay a whole chunk so that the consumer doesn't touch the disk
+            # for every object.
+            while self._disk_count and len(self._mem) < self.hwm:
+                self._mem.append(self._read())
+        return self._mem.popleft()
+
+    def _read(self):
+        if self._reader is None:
+            if self._writer and len(self._segs) == 1:
+                self._seal()  # Only read from immutable segments.
+            seq = self._segs[0]
+            with open(self._seg_path(seq), "rb") as file:
+                self._reader = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._offset = 0
+            if self._head and self._head[0] == seq:
+                self._offset = self._head[1]
+                self._head = None
+        reader, offset = self._reader, self._offset
+        (size,) = self._header.unpack_from(reader, offset)
+        offset += self._header.size
+        obj = pickle.loads(reader[offset : offset + size])
+        self._offset = offset + size
+        self._disk_count -= 1
+        if self._offset >= len(reader):
+            reader.close()
+            self._reader = None
+            os.remove(self._seg_path(self._segs.popleft()))
+        return obj
+
+    def _seal(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def _append(self, file, obj):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        file.write(self._header.pack(len(data)))
+        file.write(data)
+
+    def _scan(self, path, offset):
+        count = 0
+        with open(path, "r+b") as file:
+            size = os.fstat(file.fileno()).st_size
+            while offset + self._header.size <= size:
+                file.seek(offset)
+                (length,) = self._header.unpack(file.read(self._header.size))
+                if offset + self._header.size + length > size:
+                    break
+                offset += self._header.size + length
+                count += 1
+            file.truncate(offset)  # Drop a record torn by a crash, if any.
+        return count
+
+    def _seg_path(self, seq):
+        return os.path.join(self.path, "%s.seg" % seq)
+
+
+# Build read-only state in the parent before forking workers and move every
+# object to the permanent GC generation, so that collections in the children
+# don't write to (and copy) the pages inherited from the parent.
+def preload(build, *args, **kwargs):
+    state = build(*args, **kwargs)
+    gc.collect()
+    gc.freeze()
+    return state
+
 
+# Array in a shared anonymous mmap (or in a mmaped file, if path is given):
+# children forked after its creation see the same pages, and reading it
+# doesn't touch any refcount.
+def shared_array(typecode, data_or_size, path=None):
+    itemsize = struct.calcsize(typecode)
+    size = data_or_size if isinstance(data_or_size, int) else len(data_or_size)
+    if path is None:
+        buffer = mmap.mmap(-1, size * itemsize)
+    else:
+        with open(path, "a+b") as file:
+            file.truncate(size * itemsize)
+            buffer = mmap.mmap(file.fileno(), size * itemsize)
+    if not isinstance(data_or_size, int):
+        struct.pack_into("%s%s" % (size, typecode), buffer, 0, *data_or_size)
+    return memoryview(buffer).cast(typecode)
 
-def new_queue(hwm=None, shared=False, pack=1):
+
+def prefetch(iterable, depth=2, chunk=1, new_process=False):
+    queue = new_queue(depth, new_process)  # Up to depth chunks ahead.
+    stop = (mp if new_process else mt).Event()
+    Worker(_produce, iterable, chunk, queue, stop, new_process=new_process).start()
+    yield from _consume(queue, stop)
+
+
+def _produce(iterable, chunk, queue, stop):
+    try:
+        for objs in chunks(iterable, chunk):
+            if not _put_unless(queue, list(objs), stop):
+                break
+        else:
+            _put_unless(queue, Task.Stop, stop)
+    except Exception as error:
+        _put_unless(queue, _Raise(error), stop)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+def _put_unless(queue, obj, stop):
+    while not stop.is_set():
+        try:
+            queue.put(obj, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _consume(queue, stop):
+    try:
+        while True:
+            objs = queue.get()
+            if objs is Task.Stop:
+                return
+            if isinstance(objs, _Raise):
+                raise objs.error
+            yield from objs
+    finally:
+        stop.set()  # The producer closes the source at its next put.
+
+
+class _Raise:
+    def __init__(self, error):
+        self.error = error
+
+
+def new_queue(hwm=None, shared=False, pack=1, serializer=None):
     queue_class = mp.Queue if shared else Queue
-    return queue_class(int((hwm or default_hwm) / pack))
+    queue = queue_class(int((hwm or default_hwm) / pack))
+    return SerialQueue(queue, serializer) if serializer else queue
+
+
+def _task_queue(queue, hwm, shared, serializer, monitor):
+    serializer = as_serializer(serializer)
+    if monitor is not None and not getattr(serializer, "generic", True):
+        raise ValueError("Monitored queues need a generic serializer")
+    if queue is None:
+        return new_queue(hwm, shared, serializer=serializer)
+    return SerialQueue(queue, serializer) if serializer else queue
+
+
+# Serializes the objects put in the wrapped queue, eg. to replace the default
+# pickling of multiprocessing queues. Task.Stop is passed through as is.
+class SerialQueue:
+    def __init__(self, queue, serializer):
+        self._queue = queue
+        serializer = as_serializer(serializer)
+        self._dumps, self._loads = serializer.dumps, serializer.loads
+        self.maxsize = getattr(queue, "maxsize", getattr(queue, "_maxsize", 0))
+        self.hwm = getattr(queue, "hwm", None)
+
+    def put(self, obj, *args, **kwargs):
+        self._queue.put(obj if _is_stop(obj) else self._dumps(obj), *args, **kwargs)
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def get(self, *args, **kwargs):
+        obj = self._queue.get(*args, **kwargs)
+        return obj if _is_stop(obj) else self._loads(obj)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self._queue.qsize()
 
+    def empty(self):
+        return self._queue.empty()
 
-def dequeue(queue, at_least=0, at_most=None):
+
+def _is_stop(obj):
+    if type(obj) is tuple and len(obj) == 2:  # Timestamped by a monitored task.
+        obj = obj[1]
+    return obj is Task.Stop
+
+
+def as_serializer(serializer):
+    if isinstance(serializer, str):
+        serializer = serializers[serializer]()
+    return serializer
+
+
+# Pickle protocol 5 (when available) with out-of-band buffers (bytearrays,
+# NumPy arrays...) framed after the pickle instead of copied into it. Pickles
+# without such buffers are passed as is.
+class Pickle:
+    protocol = min(5, pickle.HIGHEST_PROTOCOL)
+    _header = struct.Struct("<cI")
+
+    def dumps(self, obj):
+        if self.protocol < 5:
+            return pickle.dumps(obj, self.protocol)
+        buffers = []
+        data = pickle.dumps(obj, self.protocol, buffer_callback=buffers.append)
+        if not buffers:
+            return data
+        raws = [b.raw() for b in buffers]
+        sizes = [len(data)] + [r.nbytes for r in raws]
+        header = self._header.pack(b"B", len(sizes))
+        sizes = struct.pack("<%sQ" % len(sizes), *sizes)
+        return b"".join([header, sizes, data, *raws])
+
+    def loads(self, frame):
+        if frame[:1] != b"B":  # Pickles start with the PROTO opcode.
+            return pickle.loads(frame)
+        frame = memoryview(frame)
+        _, count = self._header.unpack_from(frame)
+        sizes = struct.unpack_from("<%sQ" % count, frame, self._header.size)
+        offset = self._header.size + 8 * count
+        parts = []
+        for size in sizes:
+            parts.append(frame[offset : offset + size])
+            offset += size
+        return pickle.loads(parts[0], buffers=parts[1:])
+
+
+class Marshal:  # Plain data only: None, bool, numbers, str, bytes, containers.
+    dumps = staticmethod(marshal.dumps)
+    loads = staticmethod(marshal.loads)
+
+
+class MsgPack:  # Plain data only, tuples are loaded as lists.
+    def __init__(self, **kwargs):
+        import msgpack
+
+        self.dumps = partial(msgpack.packb, **kwargs)
+        self.loads = partial(msgpack.unpackb, strict_map_key=False)
+
+
+# Fixed-shape records, as tuples or as dicts if the field names are given.
+class Struct:
+    generic = False
+
+    def __init__(self, format, names=None):
+        self._struct = struct.Struct(format)
+        self._names = names
+
+    def dumps(self, record):
+        if self._names:
+            record = [record[n] for n in self._names]
+        return self._struct.pack(*record)
+
+    def loads(self, data):
+        record = self._struct.unpack(data)
+        return dict(zip(self._names, record)) if self._names else record
+
+
+serializers = dict(pickle=Pickle, marshal=Marshal, msgpack=MsgPack)
+
+
+# Both paths return a list, blocking at call time until at_least objects are
+# available or the timeout expires.
+def dequeue(queue, at_least=0, at_most=None, timeout=None):
+    if isinstance(queue, Queue):
+        return _bulk_dequeue(queue, at_least, at_most, timeout)
+    return _dequeue(queue, at_least, at_most, timeout)
+
+
+def _dequeue(queue, at_least, at_most, timeout):
     at_most = at_most or queue.qsize()
-    for _ in range(at_least):
-        yield queue.get()
+    deadline = None if timeout is None else monotonic() + timeout
+    objs = []
     try:
+        for _ in range(at_least):
+            if deadline is not None:
+                timeout = max(0, deadline - monotonic())
+            objs.append(queue.get(timeout=timeout))
         for _ in range(at_most - at_least):
-            yield queue.get_nowait()
+            objs.append(queue.get_nowait())
     except Empty:
         pass
+    return objs
+
+
+def _bulk_dequeue(queue, at_least, at_most, timeout):
+    # Drain in a single critical section instead of a get() per object, and
+    # wake all the producers waiting for room with a single notify.
+    with queue.not_empty:
+        at_most = max(at_least, at_most or queue._qsize())
+        deadline = None if timeout is None else monotonic() + timeout
+        while queue._qsize() < at_least:
+            if deadline is None:
+                queue.not_empty.wait()
+            else:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                queue.not_empty.wait(remaining)
+        objs = [queue._get() for _ in range(min(at_most, queue._qsize()))]
+        if objs:
+            queue.not_full.notify(len(objs))
+    return objs
 
 
 def packer(put, size):
@@ -11,7 +11,13 @@ with open(os.path.join(current_dir, "gcd", "VERSION"), "r") as version_file:
 with open(os.path.join(current_dir, "README.rst")) as readme_file:
     readme = readme_file.read()
 
-extras_require = {"store": ["psycopg2"]}
+extras_require = {
+    "store": ["psycopg2"],
+    "msgpack": ["msgpack"],
+    "numpy": ["numpy"],
+    "orjson": ["orjson"],
+    "ujson": ["ujson"],
+}
 extras_require["all"] = list(set(chain(*extras_require.values())))
 
 setup(
@@ -19,6 +25,7 @@ setup(
     description="Utils functions for Python3",
     version=version,
     packages=["gcd"],
+    python_requires=">=3.7",
     extras_require=extras_require,
     long_description=readme,
     long_description_content_type="text/x-rst",
@@ -26,8 +33,6 @@ setup(
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
         "Operating System :: OS Independent",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Topic :: Software Development",
         "License :: OSI Approved :: BSD License",
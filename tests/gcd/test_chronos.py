@@ -24,6 +24,17 @@ class TestTimer(TestCase):
             time.return_value = current_time
             self.assertEqual(timer.is_time, is_time)
 
+    @patch("time.time")
+    def test_skipped(self, time):
+        time.return_value = 10
+        timer = Timer(period=5)
+        time.return_value = 31
+        self.assertTrue(timer.is_time)
+        self.assertEqual(timer.skipped, 3)
+        time.return_value = 35
+        self.assertTrue(timer.is_time)
+        self.assertEqual(timer.skipped, 0)
+
 
 class TestTask(TestCase):
     def test(self):
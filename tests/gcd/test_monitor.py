@@ -1,10 +1,45 @@
 import logging
+import marshal
+import threading
 import json
 import io
+import asyncio
+import os
+import tempfile
+import socket
+import urllib.request
+import time
 
+from importlib.util import find_spec
+from math import exp
+from contextlib import nullcontext
 from unittest import TestCase, main
+from unittest.mock import MagicMock, Mock
 
-from gcd.monitor import JsonFormatter, Statistics, Forgetter
+from gcd.monitor import (
+    DictFormatter,
+    JsonFormatter,
+    Statistics,
+    Forgetter,
+    Histogram,
+    StatisticsFamily,
+    Meter,
+    HyperLogLog,
+    CountMin,
+    SpaceSaving,
+    Monitor,
+    ShardedMonitor,
+    Span,
+    Exporter,
+    ContextFilter,
+    StoreHandler,
+    JsonLogStore,
+    FileLogStore,
+    SharedMonitor,
+)
+from gcd.monitor import _CopyStream
+from gcd.store import Transaction
+from gcd.work import Process
 
 
 class TestStatistics(TestCase):
@@ -41,6 +76,683 @@ class TestStatistics(TestCase):
         self.assertAlmostEqual(stats.min, emin)
         self.assertAlmostEqual(stats.max, emax)
 
+    def test_merge(self):
+        xs = 1, 2, 3, 4, 5, 6
+        ts = 1, 2, 3, 4, 6, 5
+        for memory in 1, 0.9:
+            expected = Statistics(memory, True)
+            for x, t in zip(xs, ts):
+                expected.add(x, time=t)
+            stats, other = Statistics(memory, True), Statistics(memory, True)
+            for x, t in zip(xs[:4], ts[:4]):
+                stats.add(x, time=t)
+            for x, t in zip(xs[4:], ts[4:]):
+                other.add(x, time=t)
+            stats.merge(other)
+            self.assertAlmostEqual(stats.n, expected.n)
+            self.assertAlmostEqual(stats.mean, expected.mean)
+            self.assertAlmostEqual(stats.stdev, expected.stdev)
+            self.assertAlmostEqual(stats.min, expected.min)
+            self.assertAlmostEqual(stats.max, expected.max)
+            empty = Statistics(memory, True).merge(other)
+            self.assertAlmostEqual(empty.mean, other.mean)
+            self.assertAlmostEqual(empty.min, other.min)
+
+    def test_add_many(self):
+        xs = 1, 2, 3, 4, 5
+        ws = 1, 2, 1, 2, 1
+        ts = 19, 5, 1, 20, 7
+        for memory in 1, 0.9:
+            expected = Statistics(memory, True).add(2, 1, 10)
+            for x, w, t in zip(xs, ws, ts):
+                expected.add(x, w, t)
+            stats = Statistics(memory, True).add(2, 1, 10).add_many(xs, ws, ts)
+            for attr in "n", "mean", "stdev", "min", "max":
+                self.assertAlmostEqual(getattr(stats, attr), getattr(expected, attr))
+            if memory == 1:
+                stats = Statistics(memory, True).add(2).add_many(xs, ws)
+                self.assertAlmostEqual(stats.n, expected.n)
+                self.assertAlmostEqual(stats.mean, expected.mean)
+            stats = Statistics(memory, True, (50,)).add_many(xs, ws, ts)
+            for value in list(stats.as_dict().values()) + [stats.histogram.n]:
+                self.assertIs(type(value), float)
+
+    def test_snapshot(self):
+        stats = Statistics(0.9, True).add(1, time=1).add(3, time=2)
+        copy = Statistics.from_snapshot(marshal.loads(marshal.dumps(stats.snapshot())))
+        self.assertEqual(copy.as_dict(), stats.as_dict())
+        self.assertEqual(copy.forgetter.max_time, 2)
+
+
+class TestHistogram(TestCase):
+    def test_quantiles(self):
+        histogram = Histogram(error=0.01)
+        for x in range(1, 1001):
+            histogram.add(x)
+        histogram.add(0)
+        self.assertEqual(histogram.n, 1001)
+        self.assertEqual(histogram.quantile(0), 0)
+        for q in 0.5, 0.95, 0.99:
+            self.assertAlmostEqual(histogram.quantile(q) / (q * 1000), 1, delta=0.02)
+        self.assertEqual(set(histogram.as_dict()), {"p50", "p95", "p99"})
+
+    def test_forget(self):
+        histogram = Histogram(0.5)
+        histogram.add(1, time=1)
+        histogram.add(100, time=2)
+        histogram.add(100, time=3)
+        self.assertAlmostEqual(histogram.n, 1.75)
+        self.assertAlmostEqual(histogram.quantile(0.1), 1, delta=0.02)
+        self.assertAlmostEqual(histogram.quantile(0.2), 100, delta=2)
+        for i in range(500):  # Underflow the scale.
+            histogram.add(1, time=4 + i)
+        self.assertAlmostEqual(histogram.n, 2)
+        self.assertAlmostEqual(histogram.quantile(0.99), 1, delta=0.02)
+
+    def test_merge(self):
+        histogram, other = Histogram(0.9), Histogram(0.9)
+        expected = Histogram(0.9)
+        for x in range(1, 101):
+            (histogram if x % 2 else other).add(x, time=x)
+            expected.add(x, time=x)
+        histogram.merge(Histogram.from_snapshot(other.snapshot()))
+        self.assertAlmostEqual(histogram.n, expected.n)
+        self.assertEqual(histogram.as_dict(), expected.as_dict())
+
+    def test_bounded(self):
+        histogram = Histogram(max_buckets=10)
+        for x in range(1, 1000):
+            histogram.add(x)
+        self.assertEqual(len(histogram._buckets), 10)
+        self.assertAlmostEqual(histogram.quantile(0.99) / 990, 1, delta=0.02)
+
+    def test_statistics(self):
+        stats = Statistics(0.9, True, percentiles=(50, 99))
+        batch = Statistics(0.9, True, percentiles=(50, 99))
+        for x in range(1, 101):
+            stats.add(x, time=x)
+        batch.add_many(list(range(1, 101)), times=list(range(1, 101)))
+        info = stats.as_dict()
+        self.assertEqual(set(info), {"n", "mean", "stdev", "min", "max", "p50", "p99"})
+        for key, value in batch.as_dict().items():
+            self.assertAlmostEqual(value, info[key])
+        copy = Statistics.from_snapshot(stats.snapshot()).merge(stats)
+        self.assertAlmostEqual(copy.n, 2 * stats.n)
+        self.assertEqual(copy.as_dict()["p99"], info["p99"])
+
+    def test_timeit(self):
+        monitor = Monitor()
+        for _ in range(3):
+            with monitor.timeit("x", percentiles=(95,)):
+                pass
+        self.assertIn("p95", monitor.info()["x"])
+
+
+class TestStatisticsFamily(TestCase):
+    def test(self):
+        family = StatisticsFamily(0.5, full=True)
+        expected = Statistics(0.5, full=True)
+        for t, x in enumerate([1, 5, 2, 8]):
+            family.add(("a", "x"), x, time=t + 1)
+            family.add(("b", "y"), x)
+            expected.add(x, time=t + 1)
+        stats = family["a", "x"]
+        self.assertEqual(len(family), 2)
+        for attr in ("n", "mean", "stdev", "min", "max"):
+            self.assertAlmostEqual(getattr(stats, attr), getattr(expected, attr))
+        self.assertFalse(hasattr(stats, "__dict__"))
+
+    def test_evict(self):
+        family = StatisticsFamily(ttl=0.05)
+        family.add("old", 1)
+        time.sleep(0.1)
+        family.add("new", 2)
+        self.assertNotIn("old", family)
+        family.add("newer", 3)  # Reuses the slot of old.
+        self.assertEqual(family["newer"].mean, 3)
+        self.assertEqual(len(family._n), 2)
+
+    def test_monitor(self):
+        monitor = Monitor()
+        monitor.family("latency", full=True).add(("c1", "/a"), 1)
+        monitor.family("latency").add(("c1", "/b"), 2)
+        other = Monitor.from_snapshot(marshal.loads(marshal.dumps(monitor.snapshot())))
+        other.family("latency").add(("c1", "/a"), 3)
+        monitor.merge(other)
+        info = monitor.info()
+        self.assertEqual(info["latency"]["c1"]["/a"]["n"], 3)
+        self.assertEqual(info["latency"]["c1"]["/a"]["max"], 3)
+        self.assertEqual(info["latency"]["c1"]["/b"]["mean"], 2)
+        self.assertEqual(len(list(monitor.iter_info())), 2)
+
+
+class TestMeter(TestCase):
+    def test_rates(self):
+        meter, batched = Meter(), Meter()
+        for t in range(1, 3001):
+            meter.mark(time=t)
+            if t % 10 == 0:
+                batched.mark(10, time=t)
+        for rate in meter.rates(3000):
+            self.assertAlmostEqual(rate, 1, delta=0.01)
+        for rate in batched.rates(3005):  # Halfway to the next batch.
+            self.assertAlmostEqual(rate, 1, delta=0.05)
+        # The short horizons forget faster.
+        rates = meter.rates(3120)
+        self.assertLess(rates[0], rates[1])
+        self.assertLess(rates[1], rates[2])
+        self.assertAlmostEqual(rates[0], exp(-2), delta=0.01)
+
+    def test_startup(self):
+        meter = Meter()
+        for t in range(1, 31):
+            meter.mark(2, time=t)
+        for rate in meter.rates(30):
+            self.assertAlmostEqual(rate, 2, delta=0.1)
+
+    def test_monitor(self):
+        monitor = Monitor()
+        for t in range(1, 601):
+            monitor.meter("requests").mark(time=time.time() - 600 + t)
+        snapshot = marshal.loads(marshal.dumps(monitor.snapshot()))
+        monitor.merge(Monitor.from_snapshot(snapshot))
+        info = monitor.info()["requests"]
+        self.assertEqual(info["count"], 1200)
+        self.assertEqual(set(info), {"count", "rate_1m", "rate_5m", "rate_15m"})
+        self.assertAlmostEqual(info["rate_1m"], 2, delta=0.05)
+
+
+class TestSketches(TestCase):
+    def test_hyperloglog(self):
+        hll1, hll2 = HyperLogLog(), HyperLogLog()
+        for i in range(20000):
+            hll1.add(i)
+            hll2.add(i + 10000)
+        self.assertAlmostEqual(hll1.count / 20000, 1, delta=0.03)
+        self.assertAlmostEqual(hll1.merge(hll2).count / 30000, 1, delta=0.03)
+        self.assertEqual(HyperLogLog().add("x").add("x").as_dict(), {"count": 1})
+
+    def test_hyperloglog_forget(self):
+        hll = HyperLogLog(0.5)
+        for i in range(1000):
+            hll.add(i, time=1)
+        for i in range(100):
+            hll.add("new %s" % i, time=100)
+        self.assertAlmostEqual(hll.count, 100, delta=5)
+
+    def test_count_min(self):
+        sketch = CountMin(error=0.01)
+        for i in range(1000):
+            sketch.add(i % 10, weight=2)
+        self.assertEqual(sketch.n, 2000)
+        self.assertGreaterEqual(sketch[3], 200)
+        self.assertLessEqual(sketch[3], 200 + 0.01 * 2000)
+        self.assertEqual(sketch.copy().merge(sketch)[3], 2 * sketch[3])
+
+    def test_space_saving(self):
+        sketch = SpaceSaving(k=2, capacity=5)
+        for i in range(1000):
+            sketch.add("a" if i % 2 else i)
+            sketch.add("b" if i % 3 else -i)
+        top = sketch.top()
+        self.assertEqual([item for item, _ in top], ["b", "a"])
+        self.assertGreaterEqual(top[1][1], 500)
+        merged = sketch.copy().merge(sketch)
+        self.assertEqual(merged.top(), [(item, 2 * w) for item, w in top])
+
+    def test_space_saving_forget(self):
+        sketch = SpaceSaving(0.5, k=1)
+        sketch.add("old", weight=100, time=1).add("new", time=20)
+        self.assertEqual(sketch.top()[0][0], "new")
+
+    def test_forget_snapshot(self):
+        count_min = CountMin(0.5).add("a", time=1).add("a", time=2)
+        self.assertEqual(count_min.copy()["a"], 1.5)
+        self.assertEqual(count_min.copy().n, 1.5)
+        space_saving = SpaceSaving(0.5).add("a", time=1).add("a", time=2)
+        self.assertEqual(space_saving.copy().top(), [("a", 1.5)])
+
+    def test_monitor(self):
+        monitor = Monitor()
+        for i in range(100):
+            monitor.distinct("devices").add(i % 10)
+            monitor.top("campaigns", k=1).add(i % 3)
+            monitor.frequencies("hits").add(i % 3)
+        snapshot = marshal.loads(marshal.dumps(monitor.snapshot()))
+        monitor.merge(Monitor.from_snapshot(snapshot))
+        info = monitor.info()
+        self.assertEqual(info["devices"], {"count": 10})
+        self.assertEqual(info["campaigns"], {"n": 200, "top": [(0, 68)]})
+        self.assertEqual(monitor["hits",][0], 68)
+
+
+class TestMonitor(TestCase):
+    def test_merge(self):
+        parent, child = Monitor(), Monitor()
+        parent["count"] += 1
+        child["count"] += 2
+        parent.stats("x", full=True).add(1)
+        child.stats("x", full=True).add(3)
+        child.stats("y").add(5)
+        parent.merge(
+            Monitor.from_snapshot(marshal.loads(marshal.dumps(child.snapshot())))
+        )
+        self.assertEqual(parent["count"], 3)
+        self.assertEqual(parent.info()["x"], dict(n=2, mean=2, stdev=1, min=1, max=3))
+        self.assertEqual(parent.info()["y"], dict(n=1, mean=5))
+        self.assertEqual(child.info()["y"], dict(n=1, mean=5))
+
+
+class TestShardedMonitor(TestCase):
+    def test_threads(self):
+        def work():
+            for i in range(10000):
+                monitor["count",] += 1
+                monitor.stats("x", full=True).add(i)
+
+        monitor = ShardedMonitor(service="test")
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = monitor.info()
+        self.assertEqual(info["service"], "test")
+        self.assertEqual(info["count"], 80000)
+        self.assertEqual(info["x"]["n"], 80000)
+        self.assertAlmostEqual(info["x"]["mean"], 4999.5)
+        self.assertEqual(info["x"]["max"], 9999)
+
+    def test_retire(self):
+        def work():
+            monitor["count",] += 1
+            monitor.stats("x").add(1)
+
+        monitor = ShardedMonitor()
+        for _ in range(100):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        monitor["count",] += 1
+        info = monitor.info()
+        self.assertEqual(info["count"], 101)
+        self.assertEqual(info["x"]["n"], 100)
+        self.assertEqual(len(monitor._shards), 1)  # Only the live one.
+
+
+class TestSharedMonitor(TestCase):
+    def test_processes(self):
+        def work(worker):
+            for i in range(1000):
+                monitor["count",] += 1
+                monitor.stats("x").add(i)
+            monitor["workers", "last"] = worker
+
+        monitor = SharedMonitor(
+            [("count",)], [("workers", "last")], [("x",)], service="test"
+        )
+        processes = [Process(work, i).start() for i in range(4)]
+        for process in processes:
+            process.join()
+        monitor["count",] += 1  # The parent gets its own row.
+        info = monitor.info()
+        self.assertEqual(info["service"], "test")
+        self.assertEqual(info["count"], 4001)
+        self.assertEqual(info["workers"]["last"], 0 + 1 + 2 + 3)
+        self.assertEqual(info["x"]["n"], 4000)
+        self.assertAlmostEqual(info["x"]["mean"], 499.5)
+        self.assertEqual(info["x"]["min"], 0)
+        self.assertEqual(info["x"]["max"], 999)
+
+    def test_memory(self):
+        monitor = SharedMonitor(stats=[("x",)], memory=0.5)
+        monitor.stats("x").add(1, time=1).add(3, time=2)
+        expected = Statistics(0.5, full=True).add(1, time=1).add(3, time=2)
+        info = monitor.info()
+        self.assertAlmostEqual(info["x"]["n"], expected.n)
+        self.assertAlmostEqual(info["x"]["mean"], expected.mean)
+        with self.assertRaises(KeyError):
+            monitor["unregistered",] += 1
+
+    def test_seqlock(self):
+        monitor = SharedMonitor(stats=[("x",)])
+        stats = monitor.stats("x")
+        stats.add(1).add_many([2, 3]).merge(Statistics(full=True).add(4))
+        self.assertEqual(stats._seq, 6)  # Even, once per outermost write.
+        self.assertEqual(monitor.info()["x"]["n"], 4)
+
+    def test_reuse_rows(self):
+        def work():
+            monitor["count",] += 1
+
+        monitor = SharedMonitor([("count",)], processes=2)
+        monitor["count",] += 1
+        for _ in range(3):  # Each takes over the row of the previous one.
+            Process(work).start().join()
+        self.assertEqual(monitor.info()["count"], 4)
+
+
+class TestSpan(TestCase):
+    def test_nesting(self):
+        monitor = Monitor()
+
+        @monitor.span("parse")
+        def parse():
+            time.sleep(0.01)
+
+        with monitor.span("request"):
+            parse()
+            with monitor.span("handle"):
+                parse()
+                time.sleep(0.01)
+        parse()
+        spans = monitor.info()["spans"]
+        self.assertEqual(
+            set(spans),
+            {"request", "request/parse", "request/handle", "request/handle/parse"}
+            | {"parse"},
+        )
+        request, handle = spans["request"], spans["request/handle"]
+        self.assertGreaterEqual(request["total"]["mean"], 0.03)
+        self.assertLess(request["self"]["mean"], 0.005)
+        self.assertGreaterEqual(handle["total"]["mean"], 0.02)
+        self.assertAlmostEqual(handle["self"]["mean"], 0.01, delta=0.005)
+        self.assertEqual(spans["parse"]["total"]["n"], 1)
+
+    def test_sample(self):
+        monitor = Monitor()
+        for _ in range(10):
+            with monitor.span("outer", sample=5):
+                with monitor.span("inner"):
+                    pass
+        spans = monitor.info()["spans"]
+        self.assertEqual(spans["outer"]["total"]["n"], 2)
+        self.assertEqual(spans["outer/inner"]["total"]["n"], 2)
+        self.assertNotIn("inner", spans)
+
+    def test_disabled(self):
+        monitor = Monitor()
+        span = monitor.span("x")
+        Span.enabled = False
+        try:
+            with span:
+                span(lambda: None)()
+        finally:
+            Span.enabled = True
+        self.assertNotIn("spans", monitor.info())
+
+    def test_recursion(self):
+        monitor = Monitor()
+
+        @monitor.span("f", sample=2)
+        def f(n):
+            return f(n - 1) + 1 if n else 0
+
+        for _ in range(2):
+            self.assertEqual(f(2), 2)
+        spans = monitor.info()["spans"]
+        self.assertEqual(set(spans), {"f", "f/f", "f/f/f"})
+        self.assertEqual(spans["f"]["total"]["n"], 1)
+
+
+class _Scalar(float):  # Reprs as NumPy scalars do.
+    def __repr__(self):
+        return "np.float64(%r)" % float(self)
+
+
+class TestExporter(TestCase):
+    def test_prometheus(self):
+        monitor = Monitor(service="test")
+        monitor["requests", "/a b"] = 2
+        monitor.stats("latency").add(1)
+        monitor["status",] = "ok"
+        monitor["ratio",] = _Scalar(0.5)
+        exporter = Exporter(monitor, address=("127.0.0.1", 0), prefix="app")
+        try:
+            self.assertEqual(exporter.export(), 4)
+            self.assertEqual(exporter.export(), 0)
+            monitor["requests", "/a b"] += 1
+            self.assertEqual(exporter.export(), 1)
+            url = "http://%s:%s/metrics" % exporter.address
+            with urllib.request.urlopen(url) as response:
+                lines = response.read().decode().splitlines()
+        finally:
+            exporter.close()  # Never started.
+        self.assertEqual(
+            sorted(lines),
+            [
+                "app_latency_mean 1.0",
+                "app_latency_n 1",
+                "app_ratio 0.5",
+                "app_requests__a_b 3",
+            ],
+        )
+
+    def test_statsd(self):
+        agent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        agent.bind(("127.0.0.1", 0))
+        agent.settimeout(5)
+        monitor = Monitor()
+        for i in range(100):
+            monitor["requests", i] = i
+        address = agent.getsockname()
+        exporter = Exporter(monitor, "statsd", address, 0.05, max_packet=100).start()
+        try:
+            lines = []
+            while len(lines) < 100:
+                packet = agent.recv(2048)
+                self.assertLessEqual(len(packet), 100)
+                lines.extend(packet.decode().split("\n"))
+        finally:
+            exporter.stop().join()
+            agent.close()
+        self.assertEqual(lines[:2], ["requests.0:0|g", "requests.1:1|g"])
+        self.assertTrue(exporter._socket._closed)  # Once the task exited.
+
+
+class TestContextFilter(TestCase):
+    def test_scopes(self):
+        context = ContextFilter(process=False, service="test")
+        record = logging.makeLogRecord({})
+        with ContextFilter.scope(request=1):
+            token = ContextFilter.push(user="u")
+            context.filter(record)
+            self.assertEqual(
+                record.context, {"service": "test", "request": 1, "user": "u"}
+            )
+            merged = record.context
+            context.filter(record)
+            self.assertIs(record.context, merged)
+            ContextFilter.pop(token)
+            context.info = {"service": "other"}
+            context.filter(record)
+            self.assertEqual(record.context, {"service": "other", "request": 1})
+        context.filter(record)
+        self.assertIs(record.context, context.info)
+
+    def test_tasks(self):
+        context = ContextFilter(process=False)
+
+        async def request(i):
+            with ContextFilter.scope(request=i):
+                await asyncio.sleep(0.01)
+                record = logging.makeLogRecord({})
+                context.filter(record)
+                return record.context["request"]
+
+        def thread(i):
+            with ContextFilter.scope(request=i):
+                time.sleep(0.01)
+                record = logging.makeLogRecord({})
+                context.filter(record)
+                results[i] = record.context["request"]
+
+        async def requests():
+            return await asyncio.gather(*(request(i) for i in range(10)))
+
+        self.assertEqual(asyncio.run(requests()), list(range(10)))
+        results = {}
+        threads = [threading.Thread(target=thread, args=(i,)) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {i: i for i in range(10)})
+
+
+class TestStoreHandler(TestCase):
+    def test_lazy_format(self):
+        class ThreadFormatter(DictFormatter):
+            def format(self, record):
+                return threading.current_thread()
+
+        store = BlockedStore()
+        store.unblock.set()
+        handler = StoreHandler(ThreadFormatter(), store, period=0.01)
+        handler.emit(logging.makeLogRecord({"msg": "hi"}))
+        handler._batcher.join()
+        self.assertIsNot(store.logs[0], threading.current_thread())
+
+    def test_overflow(self):
+        for overflow, kept in [
+            ("drop_newest", list(range(10))),
+            ("drop_oldest", list(range(90, 100))),
+        ]:
+            messages = self.overflow(overflow)
+            self.assertEqual(messages[1:], kept)
+
+    def test_sample(self):
+        messages = self.overflow("sample", levels=[logging.DEBUG, logging.ERROR])
+        # Debug records are sampled out once the queue is half full.
+        self.assertEqual(messages[1:], [0, 1, 2, 3, 4, 5, 7, 9, 11, 13])
+
+    def overflow(self, overflow, levels=[logging.INFO]):
+        store = BlockedStore()
+        monitor = Monitor()
+        handler = StoreHandler(
+            DictFormatter(), store, 0.01, 10, overflow, {logging.DEBUG: 1000}, monitor
+        )
+        handler.emit(logging.makeLogRecord({"msg": -1}))
+        store.blocked.wait(1)  # The handler thread now holds -1.
+        for i in range(100):
+            level = levels[i % len(levels)]
+            handler.emit(logging.makeLogRecord({"msg": i, "levelno": level}))
+        self.assertEqual(handler.dropped, 90)
+        self.assertEqual(monitor["logs", "dropped"], 90)
+        store.unblock.set()
+        handler._batcher.join()
+        return [int(log["message"]) for log in store.logs]
+
+
+class TestJsonLogStore(TestCase):
+    def test_partitions(self):
+        store = JsonLogStore(create=False, partition="hour")
+        t = 1600000000 // 3600 * 3600
+        self.assertEqual(store._partition_name(t + 10), "logs_2020091312")
+        self.assertEqual(store._partition_start("logs_2020091312"), t)
+        self.assertIsNone(store._partition_start("logs_default"))
+        sql, args = store._partition_sql(t, 3600)
+        self.assertIn("DELETE FROM logs_default", sql)
+        self.assertIn("CREATE TABLE logs_2020091312 PARTITION OF logs", sql)
+        bounds = "2020-09-13 12:00:00+00", "2020-09-13 13:00:00+00"
+        self.assertEqual(args, bounds * 2)  # Moved rows, then partition bounds.
+
+    def test_query_sql(self):
+        store = JsonLogStore(create=False)
+        sql, args = store._query_sql(
+            1, 2, "app", ["ERROR", "WARNING"], {"context.service": "api"}, True, 10
+        )
+        created = "to_timestamp((log->>'created')::double precision)"
+        self.assertEqual(
+            sql,
+            "SELECT log::text FROM logs WHERE %s >= to_timestamp(%%s) AND "
+            "%s < to_timestamp(%%s) AND log->>'name' = %%s AND "
+            "log->>'levelname' = ANY(%%s) AND log @> %%s::jsonb "
+            "ORDER BY %s LIMIT 10" % (created, created, created),
+        )
+        self.assertEqual(
+            args,
+            [1, 2, "app", ["ERROR", "WARNING"], '{"context": {"service": "api"}}'],
+        )
+
+    def test_query_connection(self):
+        conn = MagicMock()
+        conn.cursor.return_value.__iter__.return_value = iter([("1",), ("2",)])
+        pool = Mock(spec=["acquire", "release"])
+        pool.acquire.return_value = conn
+        logs = JsonLogStore(pool, create=False).query()
+        self.assertEqual(next(logs), 1)
+        self.assertIsNone(Transaction.active())  # The store is free meanwhile.
+        self.assertEqual(list(logs), [2])
+        conn.rollback.assert_called_once_with()
+        pool.release.assert_called_once_with(conn)
+
+    def test_copy_stream(self):
+        logs = ['{"message": "a\\tb"}', b'{"message": "\xc3\xa9"}'] * 1000
+        stream = _CopyStream(logs)
+        data = b"".join(iter(lambda: stream.read(100), b""))
+        lines = data.decode().split("\n")[:-1]
+        self.assertEqual(len(lines), 2000)
+        self.assertEqual(lines[0], '{"message": "a\\\\tb"}')
+        self.assertEqual(json.loads(lines[1]), {"message": "\xe9"})
+
+
+class TestFileLogStore(TestCase):
+    def test(self):
+        for compress in False, True:
+            with tempfile.TemporaryDirectory() as path:
+                store = FileLogStore(path, segment_size=100, compress=compress)
+                handler = StoreHandler([], store, period=0.01)
+                for i in range(20):
+                    handler.emit(logging.makeLogRecord({"msg": {"i": i}}))
+                handler._batcher.join()
+                store.add(['{"i":\n20}', b'{"i": 21}'])
+                store.close()
+                segments = store.segments()
+                self.assertGreater(len(segments), 1)
+                self.assertEqual(segments[0].endswith(".gz"), compress)
+                replayed = ListStore()
+                store.replay(replayed)
+                logs = [json.loads(log) for log in replayed.logs]
+                self.assertEqual(logs, [{"i": i} for i in range(22)])
+                self.assertEqual(os.listdir(path), [])
+
+    def test_orphans(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = FileLogStore(path)
+            store.add(["{}"])
+            dead = "%s/0-4194305.jsonl.open" % path  # Over the maximum pid.
+            os.rename(store._file.name, dead)
+            store._file = None
+            self.assertEqual(store.segments(), [])
+            FileLogStore(path).add(["{}"])  # Completes the dead one.
+            self.assertEqual(len(store.segments()), 1)
+
+
+class ListStore:
+    def __init__(self):
+        self.logs = []
+
+    def transaction(self):
+        return nullcontext()
+
+    def add(self, logs):
+        self.logs.extend(logs)
+
+
+class BlockedStore:
+    def __init__(self):
+        self.blocked, self.unblock = threading.Event(), threading.Event()
+        self.logs = []
+
+    def add(self, logs):
+        self.blocked.set()
+        self.unblock.wait(5)
+        self.logs.extend(logs)
+
+
+json_backends = [b for b in ("json", "orjson", "ujson") if find_spec(b)]
+
 
 class TestJsonFormatter(TestCase):
     def test_msg(self):
@@ -69,6 +781,47 @@ class TestJsonFormatter(TestCase):
         self.assertIn("exc_info", json.loads(log.getvalue()))
         self.assertIn("TypeError", log.getvalue())
 
+    def test_context(self):
+        context = ContextFilter(process=False, service="test")
+        for backend in json_backends:
+            formatter = JsonFormatter(backend=backend)
+            for msg in "hi", {"context": 1}, {}:
+                record = logging.makeLogRecord({"msg": msg, "name": "test"})
+                context.filter(record)
+                expected = DictFormatter().format(record)
+                self.assertEqual(json.loads(formatter.format(record)), expected)
+            ContextFilter.instance = context
+            ContextFilter.info(version=2)
+            ContextFilter.instance = None
+            context.filter(record)
+            log = json.loads(formatter.format(record))
+            self.assertEqual(log["context"], {"service": "test", "version": 2})
+            context.info = {"service": "test"}
+
+    def test_context_threads(self):
+        formatter = JsonFormatter()
+        mismatches = []
+
+        def work(i):
+            for _ in range(2000):
+                record = logging.makeLogRecord({"msg": "", "context": {"i": i}})
+                if json.loads(formatter.format(record))["context"] != {"i": i}:
+                    mismatches.append(i)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mismatches, [])
+
+    def test_bytes(self):
+        record = logging.makeLogRecord({"msg": "hi"})
+        for backend in json_backends:
+            formatter = JsonFormatter([], backend=backend, as_bytes=True)
+            self.assertEqual(json.loads(formatter.format(record)), {"message": "hi"})
+            self.assertIsInstance(formatter.format(record), bytes)
+
     def logger(self, attrs=[]):
         log = io.StringIO()
         logger = logging.getLogger("test")
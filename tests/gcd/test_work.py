@@ -1,9 +1,37 @@
+import os
 import time
 import queue
+import tempfile
+import multiprocessing as mp
 
 from unittest import TestCase, main
 
-from gcd.work import Thread, Task, Batcher, Streamer, dequeue
+from gcd.monitor import Monitor
+from gcd.work import (
+    Process,
+    Thread,
+    Task,
+    Batcher,
+    Streamer,
+    SpillQueue,
+    SerialQueue,
+    Supervisor,
+    Scheduler,
+    Job,
+    Pickle,
+    Marshal,
+    Struct,
+    Source,
+    Map,
+    Filter,
+    Batch,
+    Sink,
+    dequeue,
+    new_queue,
+    prefetch,
+    preload,
+    shared_array,
+)
 
 
 class TestWorkers(TestCase):
@@ -64,6 +92,203 @@ class TestWorkers(TestCase):
         time.sleep(0.11)
         self.assertEqual(list(streamer), [5, 6])
 
+    def test_batcher_stops_on_error(self):
+        def handle(batch):
+            raise ValueError
+
+        batcher = Batcher(handle, period=0.05).start()
+        batcher.put(1)
+        batcher.join()
+
+    def test_monitor(self):
+        def handle(batch):
+            if 1 in batch:
+                raise ValueError
+
+        monitor = Monitor()
+        batcher = Batcher(handle, period=0.05, monitor=monitor, monitor_key="b")
+        batcher.start()
+        batcher.put(1)
+        batcher.put(2)
+        time.sleep(0.07)
+        batcher.put(3)
+        batcher.join()
+        info = monitor.info()["b"]
+        self.assertEqual(info["errors"], {"ValueError": 1})
+        self.assertAlmostEqual(info["batch"]["max"], 2, places=1)
+        self.assertGreater(info["wait"]["max"], 0.04)
+        self.assertIn("handle", info)
+        self.assertIn("lateness", info)
+
+        monitor = Monitor()
+        streamer = Streamer(
+            lambda hwm, period: [1, 2, Task.Stop], period=0.05, monitor=monitor
+        )
+        self.assertEqual(list(streamer.start()), [1, 2])
+        info = monitor.info()["streamer"]
+        self.assertAlmostEqual(info["wait"]["n"], 3, places=1)
+        self.assertIn("load", info)
+
+
+class TestSupervisor(TestCase):
+    def test_respawn(self):
+        def work():
+            starts.append(1)
+            if len(starts) < 3:
+                raise ValueError
+            time.sleep(1)
+
+        starts = []
+        supervisor = Supervisor(work, period=0.05, new_process=False).start()
+        time.sleep(0.2)
+        self.assertEqual(len(starts), 1)  # Backing off for 1 second.
+        supervisor.stop()
+
+        starts = []
+        supervisor = Supervisor(
+            work, period=0.05, max_backoff=0.1, new_process=False
+        ).start()
+        time.sleep(0.5)
+        self.assertEqual(len(starts), 3)
+        self.assertEqual(supervisor.info()["crashes"], 2)
+        self.assertEqual(supervisor.info()["workers"], 1)
+        supervisor.stop()
+
+    def test_process_crash(self):
+        supervisor = Supervisor(os._exit, 1, period=0.05, max_backoff=0).start()
+        time.sleep(0.2)
+        self.assertGreater(supervisor.info()["crashes"], 1)
+        supervisor.stop()
+
+    def test_scale(self):
+        def work():
+            for obj in iter(q.get, Task.Stop):
+                time.sleep(obj)
+
+        q = queue.Queue()
+        supervisor = Supervisor(
+            work,
+            queue=q,
+            max_workers=3,
+            backlog=1,
+            idle=1,
+            period=0.05,
+            new_process=False,
+        ).start()
+        for _ in range(20):
+            q.put(0.02)
+        time.sleep(0.12)
+        self.assertEqual(supervisor.info()["size"], 3)
+        time.sleep(0.5)
+        self.assertEqual(supervisor.info()["workers"], 1)
+        supervisor.join()
+        self.assertEqual(supervisor.info()["workers"], 1)
+
+
+class TestScheduler(TestCase):
+    def test_priority(self):
+        def log(x):
+            calls.append(x)
+
+        calls = []
+        scheduler = Scheduler(workers=1)
+        for priority in 1, 3, 2:
+            scheduler.after(0, log, priority, priority=priority)
+        time.sleep(0.01)
+        scheduler.start()
+        time.sleep(0.05)
+        self.assertEqual(calls, [3, 2, 1])
+        scheduler.stop().join()
+
+    def test_periodic(self):
+        def tick():
+            ticks.append(Job.active().skipped)
+            if len(ticks) == 3:
+                return Task.Stop
+
+        ticks = []
+        scheduler = Scheduler()
+        scheduler.every(0.05, tick)
+        time.sleep(0.12)
+        scheduler.start()
+        time.sleep(0.15)
+        self.assertEqual(ticks, [1, 0, 0])
+        scheduler.stop().join()
+
+    def test_deadline_and_stealing(self):
+        monitor = Monitor()
+        calls = []
+        scheduler = Scheduler(workers=2, monitor=monitor)
+        scheduler.after(0, time.sleep, 0.2, name="slow")
+        scheduler.after(0.01, calls.append, 1, deadline=0.05, name="fast")
+        scheduler.after(0, calls.append, 2, deadline=0, name="stale")
+        time.sleep(0.01)
+        scheduler.start()
+        time.sleep(0.05)
+        self.assertEqual(calls, [1])
+        scheduler.stop().join()
+        self.assertEqual(monitor.info()["scheduler"]["stale"]["overdue"], 1)
+
+
+class TestPipeline(TestCase):
+    def test_pipeline(self):
+        batches = []
+        pipeline = (
+            Source(range(10))
+            | Map(lambda x: x * 2, workers=3)
+            | Filter(lambda x: x % 3 == 0)
+            | Batch(2, period=0.05)
+            | Sink(batches.append)
+        ).start()
+        pipeline.join()
+        self.assertEqual(sorted(x for b in batches for x in b), [0, 6, 12, 18])
+        self.assertTrue(all(len(b) <= 2 for b in batches))
+        info = pipeline.info()
+        self.assertEqual(
+            [i["stage"] for i in info], ["Source", "Map", "Filter", "Batch", "Sink"]
+        )
+        self.assertEqual(info[1]["input"], 10)
+        self.assertEqual(info[2]["output"], 4)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            (Map(abs) | Sink(print)).start()
+        with self.assertRaises(ValueError):
+            (Source([]) | Sink(print) | Map(abs)).start()
+
+    def test_info_before_start(self):
+        info = (Source([]) | Map(abs, workers=2)).info()
+        self.assertEqual(info[1]["input"], 0)
+        self.assertEqual(info[1]["rate"], 0)
+
+    def test_batch_deadline(self):
+        def trickle():
+            for i in range(6):
+                time.sleep(0.04)
+                yield i
+
+        pipeline = (Source(trickle(), new_process=True) | Batch(100, 0.1)).start()
+        batches = list(pipeline)
+        self.assertGreater(len(batches), 1)
+        self.assertEqual([x for b in batches for x in b], list(range(6)))
+
+    def test_iter_processes(self):
+        pipeline = (Source(range(10)) | Map(abs, workers=2, new_process=True)).start()
+        self.assertEqual(sorted(pipeline), list(range(10)))
+        pipeline.join()
+
+    def test_stop(self):
+        def forever():
+            while True:
+                yield 1
+                time.sleep(0.01)
+
+        pipeline = (Source(forever()) | Map(abs, hwm=1)).start()
+        time.sleep(0.05)
+        pipeline.stop()
+        self.assertTrue(set(pipeline) <= {1})
+        pipeline.join()
+
 
 class TestQueues(TestCase):
     def test_dequeue(self):
@@ -83,6 +308,238 @@ class TestQueues(TestCase):
         time.sleep(0.05)
         self.assertEqual(list(dequeue(q, at_most=1)), [4])
 
+    def test_dequeue_shared(self):
+        q = new_queue(shared=True)
+        for i in range(3):
+            q.put(i)
+        time.sleep(0.05)  # Let the feeder thread flush.
+        self.assertEqual(dequeue(q, 1), [0, 1, 2])
+        self.assertEqual(dequeue(q, 1, timeout=0.01), [])
+
+    def test_dequeue_timeout(self):
+        q = queue.Queue()
+        q.put(1)
+        t0 = time.time()
+        self.assertEqual(list(dequeue(q, 2, timeout=0.1)), [1])
+        self.assertGreaterEqual(time.time() - t0, 0.1)
+        self.assertEqual(list(dequeue(q, 1, timeout=0)), [])
+
+    def test_dequeue_wakes_producers(self):
+        def enqueuer(obj):
+            q.put(obj)
+            put.append(obj)
+
+        q = queue.Queue(2)
+        put = []
+        q.put(1)
+        q.put(2)
+        for obj in 3, 4:
+            Thread(enqueuer, obj).start()
+        time.sleep(0.05)
+        self.assertEqual(put, [])
+        self.assertEqual(list(dequeue(q)), [1, 2])
+        time.sleep(0.05)
+        self.assertEqual(sorted(put), [3, 4])
+        self.assertEqual(sorted(dequeue(q, at_most=5)), [3, 4])
+
+
+class TestPreload(TestCase):
+    def test_preload(self):
+        def child():
+            table[0] = table[1] + len(state)
+            time.sleep(0.2)
+
+        state = preload(lambda n: list(range(n)), 1000)
+        table = shared_array("q", [1, 2, 3])
+        process = Process(child).start()
+        time.sleep(0.1)
+        self.assertGreater(process.uss, 0)
+        process.join()
+        self.assertEqual(table.tolist(), [1002, 2, 3])
+
+    def test_mmap_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "table")
+            shared_array("d", [0.5, 1.5], path)
+            self.assertEqual(shared_array("d", 2, path).tolist(), [0.5, 1.5])
+
+
+class TestPrefetch(TestCase):
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(range(10), chunk=3)), list(range(10)))
+        self.assertEqual(
+            list(prefetch(iter(range(5)), new_process=True)), [0, 1, 2, 3, 4]
+        )
+
+    def test_ahead(self):
+        def source():
+            for i in range(4):
+                read.append(i)
+                yield i
+
+        read = []
+        objs = prefetch(source(), depth=1, chunk=2)
+        self.assertEqual(next(objs), 0)
+        time.sleep(0.05)
+        self.assertEqual(read, [0, 1, 2, 3])
+        self.assertEqual(list(objs), [1, 2, 3])
+
+    def test_error(self):
+        def source():
+            yield 1
+            raise KeyError
+
+        objs = prefetch(source())
+        self.assertEqual(next(objs), 1)
+        with self.assertRaises(KeyError):
+            next(objs)
+
+    def test_close(self):
+        def source():
+            try:
+                while True:
+                    yield 1
+            finally:
+                closed.append(True)
+
+        closed = []
+        objs = prefetch(source(), depth=1)
+        self.assertEqual(next(objs), 1)
+        objs.close()
+        time.sleep(0.2)
+        self.assertEqual(closed, [True])
+
+
+class TestSerializers(TestCase):
+    def test_pickle(self):
+        pickle = Pickle()
+        obj = dict(x=1, data=bytearray(b"abc"))
+        self.assertEqual(pickle.loads(pickle.dumps(obj)), obj)
+        self.assertEqual(pickle.loads(pickle.dumps([1, "a"])), [1, "a"])
+
+    def test_struct(self):
+        struct = Struct("qd", ("id", "price"))
+        record = dict(id=1, price=0.5)
+        self.assertEqual(struct.loads(struct.dumps(record)), record)
+        struct = Struct("qd")
+        self.assertEqual(struct.loads(struct.dumps((1, 0.5))), (1, 0.5))
+
+    def test_queue(self):
+        for serializer in "pickle", Marshal(), Struct("q"):
+            q = new_queue(2, shared=True, serializer=serializer)
+            q.put((1,))
+            q.put(Task.Stop)
+            self.assertEqual(tuple(q.get()), (1,))
+            self.assertIs(q.get(), Task.Stop)
+
+    def test_batcher(self):
+        batches = mp.Queue()
+        batcher = Batcher(
+            batches.put, period=0.05, new_process=True, serializer="marshal"
+        ).start()
+        batcher.put({"x": 1})
+        batcher.join()
+        self.assertEqual(batches.get(timeout=1), [{"x": 1}])
+        with self.assertRaises(ValueError):
+            Batcher(print, serializer=Struct("q"), monitor=Monitor())
+
+    def test_monitored_batcher(self):
+        for serializer in "marshal", "pickle":
+            batches = []
+            monitor = Monitor()
+            batcher = Batcher(
+                batches.append, period=0.01, serializer=serializer, monitor=monitor
+            ).start()
+            batcher.put({"x": 1})
+            batcher.join()
+            self.assertEqual(batches, [[{"x": 1}]])
+            self.assertEqual(monitor.info()["batcher"]["batch"]["n"], 1)
+
+    def test_unbounded_queue(self):
+        self.assertEqual(SerialQueue(queue.Queue(), "pickle").maxsize, 0)
+        with tempfile.TemporaryDirectory() as path:
+            spill = SpillQueue(path, hwm=10)
+            batches = []
+            batcher = Batcher(
+                batches.append, period=0.01, queue=spill, serializer="marshal"
+            ).start()
+            batcher.put(1)
+            batcher.join()
+            spill.close()
+            self.assertEqual(batches, [[1]])
+
+
+class TestSpillQueue(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_spill(self):
+        q = SpillQueue(self.path, hwm=2, segment_size=1)
+        for i in range(6):
+            q.put_nowait(i)
+        self.assertEqual(q.qsize(), 6)
+        self.assertEqual(len(os.listdir(self.path)), 4)
+        self.assertEqual(q.get(), 0)
+        self.assertEqual(q.get(), 1)
+        q.put(6)
+        self.assertEqual(list(dequeue(q)), [2, 3, 4, 5, 6])
+        self.assertEqual(os.listdir(self.path), [])
+        q.put(7)
+        self.assertEqual(q.get(), 7)
+
+    def test_restart(self):
+        q = SpillQueue(self.path, hwm=2, segment_size=1)
+        for i in range(6):
+            q.put(i)
+        self.assertEqual(q.get(), 0)
+        self.assertEqual(q.get(), 1)
+        self.assertEqual(q.get(), 2)
+        q.close()
+        q = SpillQueue(self.path, hwm=2)
+        self.assertEqual(q.qsize(), 3)
+        q.put(6)
+        self.assertEqual(list(dequeue(q)), [3, 4, 5, 6])
+
+    def test_restart_mid_segment(self):
+        q = SpillQueue(self.path, hwm=2)
+        for i in range(10):
+            q.put(i)
+        self.assertEqual([q.get() for _ in range(3)], [0, 1, 2])
+        q.close()
+        q = SpillQueue(self.path, hwm=2)
+        self.assertEqual(dequeue(q), list(range(3, 10)))
+
+    def test_crash(self):
+        q = SpillQueue(self.path, hwm=1)
+        for i in range(3):
+            q.put(i)
+        q = SpillQueue(self.path, hwm=1)  # Without closing the previous one.
+        self.assertEqual(dequeue(q), [1, 2])
+
+    def test_streamer(self):
+        def load(hwm, period):
+            self.assertEqual(hwm, 3)
+            return [1, 2, Task.Stop]
+
+        queue = SpillQueue(self.path, hwm=3)
+        streamer = Streamer(load, period=0.05, queue=queue).start()
+        self.assertEqual(list(streamer), [1, 2])
+
+    def test_batcher(self):
+        def handle(batch):
+            batches.append(list(batch))
+
+        batches = []
+        batcher = Batcher(handle, period=0.1, queue=SpillQueue(self.path, hwm=1))
+        for i in range(3):
+            batcher.put(i, timeout=0)
+        batcher.start().join()
+        self.assertEqual(batches, [[0, 1, 2]])
+
 
 if __name__ == "__main__":
     main()